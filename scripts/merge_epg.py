@@ -1,8 +1,20 @@
-import sys, re, gzip, os, shutil, time
+import sys, os, shutil, asyncio, json, zlib, queue
+from functools import lru_cache
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from hashlib import blake2b, sha1
 from datetime import datetime, timedelta, timezone
-import requests
+import aiohttp
 from lxml import etree
-from io import BytesIO
+
+try:
+    # SIMD-accelerated deflate, drop-in for the gzip module
+    from isal import igzip as gzip
+    COMPRESS_LEVEL = 3  # isal levels are 0-3; 3 is close to zlib's 6 in ratio
+except ImportError:
+    import gzip
+    COMPRESS_LEVEL = 6  # gzip's default of 9 is much slower for almost no gain on XMLTV
 
 URLS = [
     "https://epghub.xyz/epg/EPG-BEIN.xml",
@@ -37,30 +49,49 @@ KEEP_FUTURE_DAYS = 7
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (compatible; merged-epg/1.0; +https://github.com/Junior2237/merged-epg)",
     "Accept": "*/*",
+    "Accept-Encoding": "gzip",
 }
 
+# Per socket operation, like requests' timeout: time spent queued for a pooled
+# connection is not charged, so later feeds keep their full budget
+FETCH_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=180, sock_read=180)
+CHUNK_SIZE = 65536
+CHUNK_QUEUE_SIZE = 16  # chunks buffered per source between download and parser
+MAX_CONNECTIONS = 16
+# Every feed lives on epghub.xyz, so reuse a small pool. Feeds beyond the pool
+# wait for a free connection; FETCH_TIMEOUT does not run while they wait.
+MAX_CONNECTIONS_PER_HOST = 8
+KEEPALIVE_TIMEOUT = 60
+
+# Conditional-request cache: ETag/Last-Modified per URL plus the last body on disk
+CACHE_DIR = os.path.join(".cache", "epg")
+CACHE_INDEX = os.path.join(CACHE_DIR, "fetch_cache.json")
+
+# Timezone suffixes that mean the 14-digit prefix is already UTC
+UTC_SUFFIXES = ("", "+0000", "-0000", "Z")
+
 OUTPUT_NAME = "merged_epg.xml.gz"
+XML_DECLARATION = b"<?xml version='1.0' encoding='utf-8'?>\n"
 PREVIOUS_DIST = os.path.join("dist", "epg.xml.gz")  # your last good output
 
 
+@lru_cache(maxsize=65536)
 def parse_xmltv_time(ts: str):
-    if not ts:
-        return None
-    m = re.match(r"(\d{14})(?:\s*([+\-]\d{4}|Z))?", ts)
-    if not m:
+    if len(ts) < 14 or not ts[:14].isdigit():
         return None
 
-    base = datetime.strptime(m.group(1), "%Y%m%d%H%M%S")
-    tz = m.group(2)
+    try:
+        base = datetime(int(ts[0:4]), int(ts[4:6]), int(ts[6:8]),
+                        int(ts[8:10]), int(ts[10:12]), int(ts[12:14]), tzinfo=timezone.utc)
+    except ValueError:
+        return None
 
-    if tz and tz != "Z":
-        sign = 1 if tz[0] == "+" else -1
-        hours = int(tz[1:3])
-        mins = int(tz[3:5])
-        offset = timezone(sign * timedelta(hours=hours, minutes=mins))
-        return base.replace(tzinfo=offset).astimezone(timezone.utc)
+    tz = ts.rstrip()[-5:]
+    if len(ts.rstrip()) > 14 and tz[0] in "+-" and tz[1:].isdigit():
+        offset = timedelta(hours=int(tz[1:3]), minutes=int(tz[3:5]))
+        return base - offset if tz[0] == "+" else base + offset
 
-    return base.replace(tzinfo=timezone.utc)
+    return base
 
 
 def intersects_window(start_dt, stop_dt, win_start, win_end):
@@ -73,25 +104,244 @@ def intersects_window(start_dt, stop_dt, win_start, win_end):
     return (start_dt <= win_end) and (stop_dt >= win_start)
 
 
-def fetch_xml(url, retries=3):
+def programme_key(ch_id, start_s, stop_s):
+    # 64-bit digest instead of a tuple of strings keeps the dedupe map small
+    data = f"{ch_id}\0{start_s}\0{stop_s}".encode()
+    return int.from_bytes(blake2b(data, digest_size=8).digest(), "big")
+
+
+def programme_title(data):
+    # Only needed on a dedupe clash, so re-parsing the serialized programme is fine
+    return (etree.fromstring(data).findtext("title") or "").strip()
+
+
+def utc_key(ts):
+    # 14-digit prefix of a plain-UTC stamp, "" for a missing stamp,
+    # None when a full parse is needed (other offset or malformed)
+    if not ts:
+        return ""
+    if len(ts) < 14 or ts[14:].strip() not in UTC_SUFFIXES:
+        return None
+    key = ts[:14]
+    return key if key.isdigit() else None
+
+
+def quick_in_window(start_key, stop_key, win_start_key, win_end_key):
+    # Zero-padded UTC stamps sort lexically in time order, so most programmes
+    # can be checked on their utc_key() alone. Missing stamps follow
+    # intersects_window. Returns None when a full parse is needed.
+    if start_key is None or stop_key is None:
+        return None
+    return (not start_key or start_key <= win_end_key) and (not stop_key or stop_key >= win_start_key)
+
+
+def start_sort_key(start_s):
+    # UTC-normalised start, so offsets like -0400 sort in real time order
+    key = utc_key(start_s)
+    if key is None:
+        start_dt = parse_xmltv_time(start_s)
+        key = start_dt.strftime("%Y%m%d%H%M%S") if start_dt else ""
+    return key
+
+
+def programme_in_window(elem, window):
+    win_start, win_end, win_start_key, win_end_key = window
+    start_s = elem.get("start") or ""
+    start_key = utc_key(start_s)
+    # Cheap rejection on the start attribute alone, before stop is even read
+    if start_key and start_key > win_end_key:
+        return False
+
+    stop_s = elem.get("stop") or ""
+    in_window = quick_in_window(start_key, utc_key(stop_s), win_start_key, win_end_key)
+    if in_window is None:
+        start_dt = parse_xmltv_time(start_s)
+        stop_dt = parse_xmltv_time(stop_s)
+        in_window = intersects_window(start_dt, stop_dt, win_start, win_end)
+    return in_window
+
+
+def collect_events(parser, window, channels, programmes):
+    # Kept elements are serialized right away, so the parsed tree can always be freed
+    for _, elem in parser.read_events():
+        parent = elem.getparent()
+
+        if elem.tag == "channel":
+            # Interned so ids repeated across feeds share one object in channel_ids_seen
+            cid = sys.intern(elem.get("id", ""))
+            if cid:
+                channels.append((cid, etree.tostring(elem, encoding="utf-8", with_tail=False)))
+        elif programme_in_window(elem, window):
+            programmes.append((
+                elem.get("channel") or "",
+                elem.get("start") or "",
+                elem.get("stop") or "",
+                etree.tostring(elem, encoding="utf-8", with_tail=False),
+            ))
+
+        elem.clear(keep_tail=False)
+        while elem.getprevious() is not None:
+            del parent[0]
+
+
+def load_fetch_cache():
+    try:
+        with open(CACHE_INDEX, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_fetch_cache(cache):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(CACHE_INDEX, "w", encoding="utf-8") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+
+
+def cached_body_path(url):
+    return os.path.join(CACHE_DIR, sha1(url.encode()).hexdigest() + ".bin")
+
+
+def parse_chunks(chunks, window, tee_path=None):
+    # Runs on a worker thread so parsing never blocks the event loop. Each
+    # source's parser lives on a single thread for its whole run. Returns the
+    # source's serialized channels and in-window programmes, in document order.
+    parser = etree.XMLPullParser(events=("end",), tag=("channel", "programme"))
+    channels = []
+    programmes = []
+    gunzip = None
+    head = b""
+    tee = open(tee_path, "wb") if tee_path else None
+
+    try:
+        for chunk in chunks:
+            if tee:
+                tee.write(chunk)
+            # If server returns gz bytes, decompress automatically. Chunks can
+            # be tiny, so hold bytes back until the 2-byte magic can be checked.
+            if gunzip is None:
+                head += chunk
+                if len(head) < 2:
+                    continue
+                chunk, head = head, b""
+                gunzip = zlib.decompressobj(wbits=31) if chunk[:2] == b"\x1f\x8b" else False
+            if gunzip:
+                chunk = gunzip.decompress(chunk)
+            parser.feed(chunk)
+            collect_events(parser, window, channels, programmes)
+    finally:
+        if tee:
+            tee.close()
+
+    if head:
+        # Body shorter than the magic; let the parser reject it
+        parser.feed(head)
+    parser.close()
+    collect_events(parser, window, channels, programmes)
+    return channels, programmes
+
+
+def replay_cached(body_path, window):
+    with open(body_path, "rb") as f:
+        return parse_chunks(iter(lambda: f.read(CHUNK_SIZE), b""), window)
+
+
+async def hand_off(chunks, item, parsed):
+    # Bounded put that waits for the parser to catch up without blocking the
+    # loop. Returns False once the parser has finished (usually on an error).
+    while not parsed.done():
+        try:
+            chunks.put_nowait(item)
+            return True
+        except queue.Full:
+            await asyncio.wait({parsed}, timeout=0.05)
+    return False
+
+
+async def fetch_source(session, pool, url, cache, window, retries=3):
+    # Response chunks are handed to a worker thread as they arrive, so the
+    # body is never held in memory and parsing overlaps the other downloads.
+    loop = asyncio.get_running_loop()
+    body_path = cached_body_path(url)
+    headers = {}
+    entry = cache.get(url)
+    if entry and os.path.exists(body_path):
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("lm"):
+            headers["If-Modified-Since"] = entry["lm"]
+
+    tmp_path = body_path + ".tmp"
     last = None
     for attempt in range(1, retries + 1):
         try:
-            r = requests.get(url, timeout=180, headers=HEADERS)
-            r.raise_for_status()
-            content = r.content
-
-            # If server returns gz bytes, decompress automatically
-            if content[:2] == b"\x1f\x8b":
-                content = gzip.decompress(content)
-
-            return etree.parse(BytesIO(content))
+            async with session.get(url, headers=headers, timeout=FETCH_TIMEOUT) as resp:
+                not_modified = resp.status == 304
+                if not not_modified:
+                    resp.raise_for_status()
+                    etag = resp.headers.get("ETag")
+                    last_modified = resp.headers.get("Last-Modified")
+                    os.makedirs(CACHE_DIR, exist_ok=True)
+
+                    chunks = queue.Queue(maxsize=CHUNK_QUEUE_SIZE)
+                    parsed = loop.run_in_executor(pool, parse_chunks, iter(chunks.get, None), window, tmp_path)
+                    try:
+                        async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                            # Stop downloading as soon as the parser gives up
+                            if not await hand_off(chunks, chunk, parsed):
+                                break
+                    except BaseException:
+                        await hand_off(chunks, None, parsed)
+                        await asyncio.gather(parsed, return_exceptions=True)
+                        raise
+                    await hand_off(chunks, None, parsed)
+                    result = await parsed
+
+            if not_modified:
+                # Unchanged upstream; replay the last body once the connection is back in the pool
+                try:
+                    return await loop.run_in_executor(pool, replay_cached, body_path, window)
+                except Exception:
+                    # A bad cached body would 304 the same way on every retry, so refetch in full
+                    cache.pop(url, None)
+                    headers = {}
+                    raise
+
+            if etag or last_modified:
+                os.replace(tmp_path, body_path)
+                cache[url] = {"etag": etag, "lm": last_modified}
+            else:
+                os.remove(tmp_path)
+                cache.pop(url, None)
+
+            return result
         except Exception as e:
             last = e
-            time.sleep(2 * attempt)
+            # Don't leave a partial body behind for actions/cache to save
+            with suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            await asyncio.sleep(2 * attempt)
     raise last
 
 
+async def gather_all(urls, window):
+    # All feeds are fetched and parsed concurrently; results come back in URL order
+    cache = load_fetch_cache()
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONNECTIONS,
+        limit_per_host=MAX_CONNECTIONS_PER_HOST,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+    )
+    # One worker per open connection: a parse job only starts once its response is open
+    with ThreadPoolExecutor(max_workers=MAX_CONNECTIONS) as pool:
+        async with aiohttp.ClientSession(headers=HEADERS, connector=connector) as session:
+            results = await asyncio.gather(
+                *(fetch_source(session, pool, u, cache, window) for u in urls), return_exceptions=True
+            )
+    save_fetch_cache(cache)
+    return results
+
+
 def fallback_to_previous():
     # If we have a previous dist file, copy it and exit success (0)
     if os.path.exists(PREVIOUS_DIST):
@@ -105,60 +355,68 @@ def fallback_to_previous():
 
 
 def main():
-    now = datetime.now(timezone.utc)
+    now = datetime.now(timezone.utc).replace(microsecond=0)
     win_start = now - timedelta(days=KEEP_PAST_DAYS)
     win_end = now + timedelta(days=KEEP_FUTURE_DAYS)
+    win_start_key = win_start.strftime("%Y%m%d%H%M%S")
+    win_end_key = win_end.strftime("%Y%m%d%H%M%S")
 
-    tv_root = etree.Element("tv")
+    channels_out = []
+    programmes_out = []
     channel_ids_seen = set()
-    programme_keys_seen = set()
+    programme_keys_seen = {}  # key -> first programme's bytes, or the set of titles once keys clash
+
+    window = (win_start, win_end, win_start_key, win_end_key)
+    results = asyncio.run(gather_all(URLS, window))
     sources_ok = 0
 
-    for url in URLS:
-        try:
-            doc = fetch_xml(url)
-            sources_ok += 1
-        except Exception as e:
-            print(f"⚠️ Failed to fetch {url}: {e}", file=sys.stderr)
+    # Dedupe in URL order so the first source listed wins, as before
+    for url, result in zip(URLS, results):
+        if isinstance(result, BaseException):
+            print(f"⚠️ Failed to fetch {url}: {type(result).__name__}: {result}", file=sys.stderr)
             continue
+        sources_ok += 1
+        channels, programmes = result
 
-        root = doc.getroot()
-
-        for ch in root.findall("channel"):
-            cid = ch.get("id") or ""
-            if cid and cid not in channel_ids_seen:
+        for cid, data in channels:
+            if cid not in channel_ids_seen:
                 channel_ids_seen.add(cid)
-                tv_root.append(ch)
+                channels_out.append((cid, data))
 
-        for pr in root.findall("programme"):
-            ch_id = pr.get("channel") or ""
-            start_s = pr.get("start") or ""
-            stop_s = pr.get("stop") or ""
+        for ch_id, start_s, stop_s, data in programmes:
+            key = programme_key(ch_id, start_s, stop_s)
 
-            start_dt = parse_xmltv_time(start_s)
-            stop_dt = parse_xmltv_time(stop_s)
-
-            if not intersects_window(start_dt, stop_dt, win_start, win_end):
+            # The title only breaks ties, so it is looked up on a clash only
+            seen = programme_keys_seen.get(key)
+            if seen is None:
+                programme_keys_seen[key] = data
+                programmes_out.append((start_sort_key(start_s), data))
                 continue
+            if not isinstance(seen, set):
+                seen = programme_keys_seen[key] = {programme_title(seen)}
 
-            title_text = (pr.findtext("title") or "").strip()
-            key = (ch_id, start_s, stop_s, title_text)
-
-            if key in programme_keys_seen:
-                continue
-
-            programme_keys_seen.add(key)
-            tv_root.append(pr)
+            title_text = programme_title(data)
+            if title_text not in seen:
+                seen.add(title_text)
+                programmes_out.append((start_sort_key(start_s), data))
 
     # If everything failed (like your screenshot: all 502), fallback
-    if sources_ok == 0 or (len(channel_ids_seen) == 0 and len(programme_keys_seen) == 0):
+    if sources_ok == 0 or (len(channel_ids_seen) == 0 and len(programmes_out) == 0):
         fallback_to_previous()
 
-    tree = etree.ElementTree(tv_root)
-    with gzip.open(OUTPUT_NAME, "wb") as f:
-        tree.write(f, encoding="utf-8", xml_declaration=True, pretty_print=False)
+    # Sort once for tidy output, then copy the serialized elements straight into the gzip file
+    channels_out.sort(key=itemgetter(0))
+    programmes_out.sort(key=itemgetter(0))
+
+    with gzip.open(OUTPUT_NAME, "wb", compresslevel=COMPRESS_LEVEL) as f:
+        f.write(XML_DECLARATION)
+        f.write(b"<tv>")
+        # writelines over map() keeps the per-element loop in C
+        f.writelines(map(itemgetter(1), channels_out))
+        f.writelines(map(itemgetter(1), programmes_out))
+        f.write(b"</tv>\n")
 
-    print(f"✅ Merge OK. Sources: {sources_ok}/{len(URLS)} | Channels: {len(channel_ids_seen)} | Programmes: {len(programme_keys_seen)}")
+    print(f"✅ Merge OK. Sources: {sources_ok}/{len(URLS)} | Channels: {len(channel_ids_seen)} | Programmes: {len(programmes_out)}")
 
 
 if __name__ == "__main__":